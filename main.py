@@ -13,7 +13,7 @@ import taichi as ti
 from mpm import Mpm
 from reflect import Reflect
 
-ti.init(arch=ti.cpu)
+ti.init(arch=ti.gpu, default_fp=ti.f32, fast_math=True)
 
 # object parameters(constants)
 res = (512, 512)  # resolution
@@ -28,39 +28,120 @@ cap_center = (ti.Vector([0.5, 0.5]) + ti.Vector(cap_shift))*res[0]  # center of
 mpm = Mpm('obj.png')
 kaleidoscope = Reflect(center, n_mirrors, mirror_radius, res)
 
+# static cap regions of the object pixels, and their angle around the cap center
+CAP_INSIDE, CAP_BOUNDARY, CAP_OUTSIDE = 0, 1, 2
+cap_region = ti.field(ti.i32, res)
+cap_angle = ti.field(float, res)
+
 
 @ti.kernel
-def get_pixels():
+def init_cap():
+    """classify the object pixels by the cap circle once, since only the boundary stripes rotate.
+    """
+    for i, j in cap_region:
+        dpos = ti.Vector([i, j]) - cap_center
+        r2 = dpos.norm_sqr()
+        if r2 < (res[0]/2)**2:
+            cap_region[i, j] = CAP_INSIDE
+        elif r2 < (res[0]/2 + 10)**2:
+            cap_region[i, j] = CAP_BOUNDARY
+        else:
+            cap_region[i, j] = CAP_OUTSIDE
+        cap_angle[i, j] = ti.atan2(dpos[1], dpos[0])
+
+
+# particles binned into square pixel buckets, so that each pixel only gathers the particles near it
+splat_radius = 2  # particles are drawn as gaussians over (2 * splat_radius + 1)^2 pixels
+bucket_size = 8  # side of a bucket in pixels, a pixel still gathers from at most 2x2 buckets
+n_buckets = (res[0] // bucket_size, res[1] // bucket_size)
+particle_pixel = ti.Vector.field(2, ti.i32, mpm.particle_count)  # pixel position of each particle
+bucket_count = ti.field(ti.i32, n_buckets)  # number of particles in each bucket
+bucket_offset = ti.field(ti.i32, n_buckets)  # start of each bucket in bucket_particles
+bucket_particles = ti.field(ti.i32, mpm.particle_count)  # particle indices grouped by bucket
+
+
+@ti.func
+def bucket_of(pixel):
+    """get the bucket of a pixel position, clamped so that particles just off the screen are kept at the border.
+    """
+    return ti.max(ti.min(pixel // bucket_size, ti.Vector(n_buckets) - 1), 0)
+
+
+@ti.func
+def is_drawn(pixel):
+    """check whether a particle at the pixel position reaches the screen.
+    """
+    return ti.min(pixel + splat_radius, ti.Vector(res) - 1 + splat_radius - pixel).min() >= 0
+
+
+@ti.func
+def bin_particles():
+    """counting-sort the particles into the pixel buckets.
+    """
+    for bi, bj in bucket_count:
+        bucket_count[bi, bj] = 0
+    for k in mpm.x:
+        particle_pixel[k] = ti.floor(mpm.x[k] * ti.Vector(res) + ti.Vector(res) * ti.Vector(cap_shift)).cast(ti.i32)
+        if is_drawn(particle_pixel[k]):
+            ti.atomic_add(bucket_count[bucket_of(particle_pixel[k])], 1)
+    for _ in range(1): # serial prefix sum, each offset ends up at the bucket end
+        end = 0
+        for bi in range(n_buckets[0]):
+            for bj in range(n_buckets[1]):
+                end += bucket_count[bi, bj]
+                bucket_offset[bi, bj] = end
+    for k in mpm.x:
+        # filling each bucket from its end moves the offset back to the bucket start
+        if is_drawn(particle_pixel[k]):
+            bucket_particles[ti.atomic_sub(bucket_offset[bucket_of(particle_pixel[k])], 1) - 1] = k
+
+
+@ti.kernel
+def get_pixels(visible_only: ti.i32):
     """calculate the pixels for kaleidoscpoe from the mpm update.
+    Args:
+        visible_only (int): only draw the particles on the object pixels that appear in the image.
     """
     theta0 = mpm.theta[None]
     pi = 3.1415927
-    #draw the background
+    bin_particles()
     for i, j in kaleidoscope.obj_pixels:
-        dpos = ti.Vector([i, j]) - cap_center
-        r = dpos.norm()
+        #draw the background
+        region = cap_region[i, j]
+        color = ti.Vector([0.6, 0.6, 0.6]) # outside the cap circle
         # white for inside the cap circle
-        if r < res[0]/2:
-            kaleidoscope.obj_pixels[i, j] = ti.Vector([1, 1, 1])
-        # draw the boundary in dark gray, and light gray for outside the cap circle 
-        else:
-            theta = ti.acos(dpos.dot(ti.Vector([ti.cos(theta0), ti.sin(theta0)])) / r)
-            if r - res[0]/2 < 10 and int((theta + pi / 60) / (pi / 30)) % 2 == 0:
-                kaleidoscope.obj_pixels[i, j] = ti.Vector([0.2, 0.2, 0.2]) # draw the boundary
-            else:
-                kaleidoscope.obj_pixels[i, j] = ti.Vector([0.6, 0.6, 0.6]) # outside the cap circle
+        if region == CAP_INSIDE:
+            color = ti.Vector([1.0, 1.0, 1.0])
+        # draw the boundary in dark gray, and light gray for outside the cap circle
+        # 60 stripes per turn is even, so the stripe parity needs no wrapping of theta
+        elif region == CAP_BOUNDARY and int(ti.floor((cap_angle[i, j] - theta0 + pi / 60) / (pi / 30))) % 2 == 0:
+            color = ti.Vector([0.2, 0.2, 0.2]) # draw the boundary
 
-    # draw the particles
-    for k in mpm.x:
-        for i, j in ti.static(ti.ndrange(11, 11)):
-            d_norm = ti.Vector([i - 5.0, j - 5.0]).norm(1e-3)
-            if d_norm < 5.0:
-                x = int(mpm.x[k][0] * res[0] + i - 5 + res[0] * cap_shift[0])
-                y = int(mpm.x[k][1] * res[1] + j - 5 + res[1] * cap_shift[1])
-                if x > 0 and x < res[0] and y > 0 and y < res[1]:
-                    weight = 1 / (d_norm + 1.0) # weight higher when nearer to the particle position(center)
-                    kaleidoscope.obj_pixels[x, y] = mpm.color[k] * weight + kaleidoscope.obj_pixels[x, y] * (1 - weight)
+        # gather the particles within splat_radius, blended independently of their order
+        color_sum = ti.Vector([0.0, 0.0, 0.0])
+        weight_sum = 0.0
+        transparency = 1.0
+        pixel = ti.Vector([i, j])
+        # in the image, only the object pixels reached by the mirrors are visible
+        if not visible_only or kaleidoscope.reach_mask[i, j]:
+            b_lo = bucket_of(pixel - splat_radius)
+            b_hi = bucket_of(pixel + splat_radius)
+            for bi in range(b_lo[0], b_hi[0] + 1):
+                for bj in range(b_lo[1], b_hi[1] + 1):
+                    for s in range(bucket_offset[bi, bj], bucket_offset[bi, bj] + bucket_count[bi, bj]):
+                        k = bucket_particles[s]
+                        d = pixel - particle_pixel[k]
+                        if ti.abs(d).max() <= splat_radius:
+                            # gaussian weight, higher when nearer to the particle position(center)
+                            weight = ti.exp(-d.norm_sqr() / 4.0)
+                            color_sum += mpm.color[k] * weight
+                            weight_sum += weight
+                            transparency *= 1 - weight
+        if weight_sum > 0:
+            color = color_sum / weight_sum * (1 - transparency) + color * transparency
+        kaleidoscope.obj_pixels[i, j] = color
 
+init_cap()
 gui = ti.GUI('Kaleidoscope', res=res)
 gui.fps_limit = 30
 show_obj = False
@@ -82,15 +163,14 @@ while gui.running:
     # mpm simulator
     mpm.step(2e-3, omega)
     # transfer particle data to pixels
-    get_pixels()
+    get_pixels(not show_obj)
     # get image from object
     kaleidoscope.update_img()
     # show image
     if show_obj:
         gui.set_image(kaleidoscope.obj_pixels)
         for k in range(n_mirrors):
-            gui.line(kaleidoscope.mirror_pts[k].to_numpy() / res[0],
-                     kaleidoscope.mirror_pts[k + 1].to_numpy() / res[0], color=0)
+            gui.line(kaleidoscope.mirror_pts_np[k], kaleidoscope.mirror_pts_np[k + 1], color=0)
     else:
         gui.set_image(kaleidoscope.img_pixels)
 
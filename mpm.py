@@ -1,5 +1,5 @@
+import numpy as np
 import taichi as ti
-from random import random
 
 # reference: https://github.com/taichi-dev/taichi/blob/master/python/taichi/examples/simulation/mpm99.py
 
@@ -17,6 +17,8 @@ class Mpm:
         self.MATERIAL_LIQUID = 0
         self.MATERIAL_JELLY = 1
         self.MATERIAL_SNOW = 2
+        self.single_material = self.MATERIAL_JELLY  # material shared by all particles, None if mixed
+        self.mixed_materials = self.single_material is None
 
         # constants
         self.particle_count = 20000 * quality**2
@@ -33,6 +35,7 @@ class Mpm:
         self.lambda_0 = self.E * self.nu / ((1 + self.nu) / (1 - 2 * self.nu))  # Lame parameters
         self.g = ti.Vector([0.0, -9.8])  # gravitational acceleration
         self.mu_boundary = 0.8  # mu at boundary
+        self.stress_coeff = -self.dt * self.p_vol * 4 * self.inv_dx * self.inv_dx  # stress to momentum scaling in P2G
 
         # cap angle
         self.theta = ti.field(float, ())
@@ -46,32 +49,49 @@ class Mpm:
         self.color = ti.Vector.field(3, float, self.particle_count)  # color
         self.color_id = ti.field(float, self.particle_count)  # color id
         self.palette = []  # list of colors (hex)
+        self.base_p = ti.Vector.field(2, int, self.particle_count)  # grid base node, cached from P2G for G2P
+        self.fx_p = ti.Vector.field(2, float, self.particle_count)  # offset from base node, cached from P2G for G2P
 
         # grids
         self.Jp = ti.field(float, self.particle_count)  # plastic deformation
-        self.grid_m = ti.field(float, (self.grid_res, self.grid_res))  # grid node mass
-        self.grid_v = ti.Vector.field(2, float, (self.grid_res, self.grid_res))  # grid node momentum
+        self.grid_m = ti.field(float)  # grid node mass
+        self.grid_v = ti.Vector.field(2, float)  # grid node momentum
+        self.grid_block = ti.root.pointer(ti.ij, self.grid_res // 8)  # sparse blocks, activated by P2G
+        self.grid_block.dense(ti.ij, 8).place(self.grid_m, self.grid_v)
 
-        # load initial state from image
+        # particle indices sorted by 4x4 grid cell blocks, so that P2G threads scatter to nearby nodes
+        self.sort_block = 4
+        self.sort_cells = self.grid_res // self.sort_block
+        self.cell_id = ti.field(ti.i32, self.particle_count)  # block of each particle
+        self.cell_count = ti.field(ti.i32, self.sort_cells**2)  # number of particles in each block
+        self.cell_offset = ti.field(ti.i32, self.sort_cells**2)  # next free slot of each block in order
+        self.order = ti.field(ti.i32, self.particle_count)  # particle indices in block order
+
+        # load initial state from image: sample positions in batches and keep the non-white ones
         pixels = ti.imread(filepath)
         roi_size = min(pixels.shape[:1])
-        for p in range(self.particle_count):
-            while True:
-                x = random()
-                y = random()
-                color_rgb = pixels[int(x * roi_size)][int(y * roi_size)]
-                color_hex = color_rgb.dot([65536, 256, 1])
-                if color_hex != 0xffffff:  # if not white
-                    if color_hex not in self.palette:
-                        self.palette.append(color_hex)
-                    self.x[p] = [x, y]
-                    self.F[p] = ti.Matrix([[1, 0], [0, 1]])
-                    self.Jp[p] = 1
-                    self.material[p] = 1
-                    self.color_id[p] = self.palette.index(color_hex)
-                    for channel in range(3):
-                        self.color[p][channel] = color_rgb[channel] / 255.0
-                    break
+        x = np.empty((0, 2))
+        color_rgb = np.empty((0, 3), dtype=pixels.dtype)
+        while len(x) < self.particle_count:
+            x_batch = np.random.rand(self.particle_count, 2)
+            idx = (x_batch * roi_size).astype(int)
+            rgb_batch = pixels[idx[:, 0], idx[:, 1]]
+            not_white = rgb_batch.astype(np.int64) @ [65536, 256, 1] != 0xffffff
+            x = np.concatenate((x, x_batch[not_white]))
+            color_rgb = np.concatenate((color_rgb, rgb_batch[not_white]))
+        x, color_rgb = x[:self.particle_count], color_rgb[:self.particle_count]
+        color_hex = color_rgb.astype(np.int64) @ [65536, 256, 1]
+        palette, color_id = np.unique(color_hex, return_inverse=True)
+        self.palette = palette.tolist()
+        self.x.from_numpy(x.astype(np.float32))
+        self.F.from_numpy(np.tile(np.eye(2, dtype=np.float32), (self.particle_count, 1, 1)))
+        self.Jp.from_numpy(np.ones(self.particle_count, dtype=np.float32))
+        material = np.full(self.particle_count, self.MATERIAL_JELLY, dtype=np.int32)
+        assert self.mixed_materials or (material == self.single_material).all(), \
+            'single_material must match the material of every particle'
+        self.material.from_numpy(material)
+        self.color_id.from_numpy(color_id.astype(np.float32))
+        self.color.from_numpy((color_rgb / 255.0).astype(np.float32))
 
     def step(self, timestep, omega):
         """Runs MPM simulation for a given timestep with omega as angular velocity.
@@ -80,9 +100,48 @@ class Mpm:
             timestep (float): Timestep.
             omega (float): Angular velocity of the kaleidoscope's cap.
         """
+        self.sort_particles()
         for _ in range(int(timestep // self.dt)):
             self.substep(omega)
-            self.theta[None] += self.dt * omega
+
+    @ti.kernel
+    def sort_particles(self):
+        """Counting-sorts the particle indices by grid cell block into order.
+
+        Particles move much less than a block per step, so sorting once per step is enough.
+        """
+        for c in self.cell_count:
+            self.cell_count[c] = 0
+        for p in self.x:
+            cell = (self.x[p] * self.inv_dx - 0.5).cast(int) // self.sort_block
+            cell = ti.max(ti.min(cell, self.sort_cells - 1), 0)
+            self.cell_id[p] = cell[0] * self.sort_cells + cell[1]
+            ti.atomic_add(self.cell_count[self.cell_id[p]], 1)
+        for _ in range(1):  # serial exclusive prefix sum
+            offset = 0
+            for c in range(self.sort_cells**2):
+                self.cell_offset[c] = offset
+                offset += self.cell_count[c]
+        for p in self.x:
+            self.order[ti.atomic_add(self.cell_offset[self.cell_id[p]], 1)] = p
+
+    @ti.func
+    def is_material(self, p, material: ti.template()):
+        """Checks the material of particle p.
+
+        If all particles share one material, the check is a compile-time constant, so the branch is folded and the
+        material field is never loaded. Otherwise the material field is read per particle.
+
+        Args:
+            p (int): Particle index.
+            material (int): Material type.
+        """
+        result = False
+        if ti.static(self.mixed_materials):
+            result = self.material[p] == material
+        else:
+            result = ti.static(self.single_material == material)
+        return result
 
     @ti.kernel
     def substep(self, omega: float):
@@ -91,41 +150,51 @@ class Mpm:
         Args:
             omega (float): Angular velocity of the kaleidoscope's cap.
         """
+        I = ti.Matrix.identity(float, 2)
+
         # reset grids
-        for i, j in self.grid_m:
-            self.grid_m[i, j] = 0
-            self.grid_v[i, j] = [0, 0]
+        for block in ti.grouped(self.grid_block):
+            ti.deactivate(self.grid_block, block)
 
         # particle to grid (P2G)
-        for p in self.x:
+        for k in self.x:
+            p = self.order[k]  # neighboring threads handle particles of the same block
             base = (self.x[p] * self.inv_dx - 0.5).cast(int)
             fx = self.x[p] * self.inv_dx - base.cast(float)
-            w = [0.5 * (1.5 - fx)**2, 0.75 - (fx - 1)**2, 0.5 * (fx - 0.5)**2]  # quadratic kernel
-            self.F[p] = (ti.Matrix.identity(float, 2) + self.dt * self.C[p]) @ self.F[p]
+            w = [0.5 * (1.5 - fx) * (1.5 - fx), 0.75 - (fx - 1.0) * (fx - 1.0), 0.5 * (fx - 0.5) * (fx - 0.5)]  # quadratic kernel
+            self.base_p[p], self.fx_p[p] = base, fx
+            self.F[p] = (I + self.dt * self.C[p]) @ self.F[p]
             h = ti.exp(10 * (1.0 - self.Jp[p]))  # hardening coefficient: snow gets harder when compressed
-            if self.material[p] == self.MATERIAL_JELLY:
+            if self.is_material(p, self.MATERIAL_JELLY):
                 h = 0.4
             mu, la = self.mu_0 * h, self.lambda_0 * h
-            if self.material[p] == self.MATERIAL_LIQUID:
-                mu = 0.0
-            U, sig, V = ti.svd(self.F[p])
-            J = 1.0
-            for d in ti.static(range(2)):
-                new_sig = sig[d, d]
-                if self.material[p] == self.MATERIAL_SNOW:
-                    new_sig = min(max(sig[d, d], 1 - 2.5e2), 1 + 4.5e-3)  # plasticity
-                self.Jp[p] *= sig[d, d] / new_sig
-                sig[d, d] = new_sig
-                J *= new_sig
-            if self.material[p] == self.MATERIAL_LIQUID:
+            stress = ti.Matrix.zero(float, 2, 2)
+            if self.is_material(p, self.MATERIAL_LIQUID):
+                # liquid has no shear stress (mu = 0), so only J is needed and the SVD can be skipped
+                J = self.F[p].determinant()
                 # reset deformation gradient to avoid numerical instability
-                self.F[p] = ti.Matrix.identity(float, 2) * ti.sqrt(J)
-            elif self.material[p] == self.MATERIAL_SNOW:
+                self.F[p] = I * ti.sqrt(J)
+                stress = I * la * J * (J - 1)
+            elif self.is_material(p, self.MATERIAL_JELLY):
+                # jelly has no plasticity, so only the rotation of F is needed, which has a closed form in 2D
+                F = self.F[p]
+                a, b = F[0, 0] + F[1, 1], F[1, 0] - F[0, 1]
+                R = ti.Matrix([[a, -b], [b, a]]) * ti.rsqrt(a * a + b * b)
+                J = F.determinant()
+                stress = 2 * mu * (F - R) @ F.transpose() + I * la * J * (J - 1)
+            else:
+                U, sig, V = ti.svd(self.F[p])
+                J = 1.0
+                for d in ti.static(range(2)):
+                    new_sig = min(max(sig[d, d], 1 - 2.5e2), 1 + 4.5e-3)  # plasticity
+                    self.Jp[p] *= sig[d, d] / new_sig
+                    sig[d, d] = new_sig
+                    J *= new_sig
                 # reconstruct elastic deformation gradient after plasticity
                 self.F[p] = U @ sig @ V.transpose()
-            stress = 2 * mu * (self.F[p] - U @ V.transpose()) @ self.F[p].transpose() + \
-                ti.Matrix.identity(float, 2) * la * J * (J - 1)
-            stress = (-self.dt * self.p_vol * 4 * self.inv_dx * self.inv_dx) * stress
+                stress = 2 * mu * (self.F[p] - U @ V.transpose()) @ self.F[p].transpose() + \
+                    I * la * J * (J - 1)
+            stress = self.stress_coeff * stress
             affine = stress + self.p_mass * self.C[p]
             for i, j in ti.static(ti.ndrange(3, 3)):  # loop over 3x3 grid node neighborhood
                 offset = ti.Vector([i, j])
@@ -137,34 +206,29 @@ class Mpm:
         # grid operations
         for i, j in self.grid_m:
             if self.grid_m[i, j] > 0:
-                self.grid_v[i, j] /= self.grid_m[i, j]
-                self.grid_v[i, j] += self.dt * self.g  # gravity
+                v = self.grid_v[i, j] / self.grid_m[i, j]
+                v += self.dt * self.g  # gravity
                 # limit inside box
-                if i < 3 and self.grid_v[i, j][0] < 0:
-                    self.grid_v[i, j][0] = 0
-                if i > self.grid_res - 3 and self.grid_v[i, j][0] > 0:
-                    self.grid_v[i, j][0] = 0
-                if j < 3 and self.grid_v[i, j][1] < 0:
-                    self.grid_v[i, j][1] = 0
-                if j > self.grid_res - 3 and self.grid_v[i, j][1] > 0:
-                    self.grid_v[i, j][1] = 0
+                v[0] = ti.select((i < 3 and v[0] < 0) or (i > self.grid_res - 3 and v[0] > 0), 0.0, v[0])
+                v[1] = ti.select((j < 3 and v[1] < 0) or (j > self.grid_res - 3 and v[1] > 0), 0.0, v[1])
                 # limit inside circle
                 dpos = ti.Vector([i * self.dx - 0.5, j * self.dx - 0.5])
-                if dpos.norm() >= 0.5 and dpos.dot(self.grid_v[i, j]) > 0:
-                    v_radial = dpos.dot(self.grid_v[i, j]) / dpos.norm()
-                    v_tangential = dpos.cross(self.grid_v[i, j]) / dpos.norm()
+                r2 = dpos.norm_sqr()
+                if r2 >= 0.25 and dpos.dot(v) > 0:
+                    inv_r = ti.rsqrt(r2)
+                    v_radial = dpos.dot(v) * inv_r
+                    v_tangential = dpos.cross(v) * inv_r
                     v_boundary = omega / 2
-                    if v_boundary > v_tangential:
-                        v_tangential = ti.min(v_boundary, v_tangential + self.mu_boundary * v_radial)
-                    else:
-                        v_tangential = ti.max(v_boundary, v_tangential - self.mu_boundary * v_radial)
-                    self.grid_v[i, j] = ti.Matrix([[0, -1], [1, 0]]) @ dpos / dpos.norm() * v_tangential
+                    v_tangential = ti.select(v_boundary > v_tangential,
+                                             ti.min(v_boundary, v_tangential + self.mu_boundary * v_radial),
+                                             ti.max(v_boundary, v_tangential - self.mu_boundary * v_radial))
+                    v = ti.Matrix([[0, -1], [1, 0]]) @ dpos * (inv_r * v_tangential)
+                self.grid_v[i, j] = v
 
         # grid to particle (G2P)
         for p in self.x:
-            base = (self.x[p] * self.inv_dx - 0.5).cast(int)
-            fx = self.x[p] * self.inv_dx - base.cast(float)
-            w = [0.5 * (1.5 - fx)**2, 0.75 - (fx - 1.0)**2, 0.5 * (fx - 0.5)**2]
+            base, fx = self.base_p[p], self.fx_p[p]  # x is unchanged since P2G
+            w = [0.5 * (1.5 - fx) * (1.5 - fx), 0.75 - (fx - 1.0) * (fx - 1.0), 0.5 * (fx - 0.5) * (fx - 0.5)]
             new_v = ti.Vector.zero(float, 2)
             new_C = ti.Matrix.zero(float, 2, 2)
             for i, j in ti.static(ti.ndrange(3, 3)):  # loop over 3x3 grid node neighborhood
@@ -176,9 +240,12 @@ class Mpm:
             self.v[p], self.C[p] = new_v, new_C
             self.x[p] += self.dt * self.v[p]  # advection
 
+        # rotate the cap
+        self.theta[None] += self.dt * omega
+
 
 if __name__ == '__main__':
-    ti.init(arch=ti.cpu)
+    ti.init(arch=ti.gpu, default_fp=ti.f32, fast_math=True)
 
     mpm = Mpm('obj.png')
 
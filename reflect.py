@@ -25,12 +25,18 @@ class Reflect:
         self.n_mirrors = n_mirrors # number of edges of mirrors
         self.mirror_pts = ti.Vector.field(2, float, self.n_mirrors + 1)
         theta = np.linspace(0, 2 * np.pi, self.n_mirrors + 1)
-        self.mirror_pts.from_numpy(np.stack((
+        mirror_pts = np.stack((
             self.center[0] + radius * np.cos(theta),
             self.center[1] + radius * np.sin(theta)
-            ), axis=-1))
+            ), axis=-1)
+        self.mirror_pts.from_numpy(mirror_pts)
+        self.mirror_pts_np = mirror_pts / res[0] # host copy in GUI coordinates, for drawing without device syncs
         self.obj_pixels = ti.Vector.field(3, float, res)
         self.img_pixels = ti.Vector.field(3, float, res)
+        # the mirrors are static, so each image pixel always maps to the same object pixel
+        self.img_lut = ti.Vector.field(2, ti.i32, res)
+        self.reach_mask = ti.field(ti.i32, res) # 1 for the object pixels that appear in the image
+        self.build_lut()
 
     @staticmethod
     @ti.func
@@ -75,26 +81,41 @@ class Reflect:
         """
         src = self.center
         dst = ti.Vector([float(i), float(j)])
-        for t in range(100): # in case it does not stop, set a maximum step
-            closest_hit = dst
-            closest_k = 0
-            for k in ti.static(range(self.n_mirrors)):
-                hit = self.intersection(src, dst, self.mirror_pts[k], self.mirror_pts[k + 1])
-                if (hit - src).dot(hit - closest_hit) < -1e-1:
-                    closest_hit = hit
-                    closest_k = k
-            if (closest_hit - dst).norm() < 1e-3:
-                break
-            src = closest_hit
-            dst = self.reflection(dst, self.mirror_pts[closest_k], self.mirror_pts[closest_k + 1])
+        # the eye is at the center, so the first mirror hit is the one spanning the ray's angular sector
+        d = dst - src
+        sector_angle = 2 * np.pi / self.n_mirrors
+        sector = ti.min(int((ti.atan2(d[1], d[0]) % (2 * np.pi)) / sector_angle), self.n_mirrors - 1)
+        hit = self.intersection(src, dst, self.mirror_pts[sector], self.mirror_pts[sector + 1])
+        if (hit - src).dot(hit - dst) < -1e-1:
+            src = hit
+            dst = self.reflection(dst, self.mirror_pts[sector], self.mirror_pts[sector + 1])
+            for t in range(20): # in case it does not stop, set a maximum step
+                closest_hit = dst
+                closest_k = 0
+                for k in ti.static(range(self.n_mirrors)):
+                    hit = self.intersection(src, dst, self.mirror_pts[k], self.mirror_pts[k + 1])
+                    if (hit - src).dot(hit - closest_hit) < -1e-1:
+                        closest_hit = hit
+                        closest_k = k
+                if (closest_hit - dst).norm() < 1e-3:
+                    break
+                src = closest_hit
+                dst = self.reflection(dst, self.mirror_pts[closest_k], self.mirror_pts[closest_k + 1])
         return dst
 
+    @ti.kernel
+    def build_lut(self):
+        """trace every image pixel once and store its object pixel in the lookup table.
+        """
+        for i, j in self.img_lut:
+            p = self.tracing(i, j)
+            self.img_lut[i, j] = [int(p[0]), int(p[1])]
+            self.reach_mask[self.img_lut[i, j]] = 1
+
     @ti.kernel
     def update_img(self):
         """update the image pixels from the object pixels.
         """
         for i, j in self.img_pixels:
-            p = self.tracing(i, j)
-            i_obj = p[0]
-            j_obj = p[1]
-            self.img_pixels[i, j] = self.obj_pixels[int(i_obj), int(j_obj)]
+            p = self.img_lut[i, j]
+            self.img_pixels[i, j] = self.obj_pixels[p[0], p[1]]